@@ -1,9 +1,20 @@
 import streamlit as st
 import requests
-import base64
-import json
-from PIL import Image
+import pybase64
+import orjson
+import re
+import sqlite3
+import string
+import hashlib
+import threading
+import time
+from PIL import Image, ImageOps
 import io
+import numpy as np
+import pandas as pd
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -20,30 +31,237 @@ except (FileNotFoundError, KeyError):
     st.warning("GEMINI_API_KEY not found in secrets. Please enter it below to run locally.", icon="⚠️")
     GEMINI_API_KEY = st.text_input("Enter your Gemini API Key:", type="password")
 
-GEMINI_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-pro:generateContent?key={GEMINI_API_KEY}"
+GEMINI_STREAM_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-pro:streamGenerateContent?alt=sse"
+GEMINI_UPLOAD_URL = "https://generativelanguage.googleapis.com/upload/v1beta/files"
+# Statuses Gemini uses for a file_data part it cannot read (expired, or uploaded with another key).
+FILE_REJECTED_STATUSES = (403, 404)
+
+# A multiple of 3, so the base64-encoded slices concatenate without padding.
+INLINE_DATA_PLACEHOLDER = "__INLINE_IMAGE_DATA__"
+INLINE_CHUNK_BYTES = 3 * 16 * 1024
+
+FLAT_OBJECT_RE = re.compile(r"\{[^{}]*\}")
+# The JSON object, then an optional "---" separator followed by the summary.
+RESPONSE_RE = re.compile(r"(\{.*?\})[^{}]*?(?:-{3,}\s*(.*?))?\s*\Z", re.DOTALL)
+
+COMPRESS_MIN_BYTES = 400_000
+ORIENTATION_TAG = 0x0112
+PREVIEW_SIZE = 600
+
+PHASH_SIZE = 32
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_DB = "semantic_cache.db"
+SEMANTIC_CACHE_TTL_SECONDS = 30 * 24 * 3600
+
+NUTRIENT_KEYS = ("calories", "protein_grams", "carbs_grams", "fat_grams")
+NUTRIENT_DEFAULTS = dict.fromkeys(NUTRIENT_KEYS, 0)
+get_nutrients = itemgetter(*NUTRIENT_KEYS)
+
+# Bump whenever a prompt changes.
+PROMPT_VERSION = "nutri-ai-v2.3"
+
+# --- Prompts ---
+ANALYSIS_PROMPT = """
+// SYSTEM IDENTITY
+You are "Nutri-AI v2.0," an advanced nutritional analysis agent powered by the Gemini 1.5 Pro model.
+Your Core Directive is to convert visual food data into structured nutritional insights with maximum accuracy and minimal user friction.
+Your Guiding Principle is: **Precision over Assumption. Inquiry over Ignorance.**
+
+---
+
+// COGNITIVE WORKFLOW: CHAIN OF THOUGHT (CoT)
+// You MUST follow this multi-step reasoning process internally before generating the final output.
+
+**Step 1: Scene Deconstruction & Holistic Recognition**
+- First, identify the overall dish or meal type. This provides top-level context.
+- Then, perform a component inventory, listing every single distinct food item.
+
+**Step 2: Evidence-Based Analysis (Internal Deduction)**
+- For each item, perform a mental check for Quantity, Preparation, and Deduction.
+- Default to **"medium" confidence** for complex, multi-ingredient dishes.
+- **Calorie Attribution Rule:** When a dish is "pan-fried" or "deep-fried," you MUST attribute the majority of added calories to **Fat** and/or **Carbs** (from breading), not Protein.
+
+**Step 3: Knowledge Gap Identification & Question Formulation**
+- Build your "question queue" based on the following priorities:
+
+    - **1. Deconstructive Questioning (Top Priority):** For a composite item (smoothie, fritters), first ask if the user can provide the raw ingredient quantities. To enable a follow-up text box, you **MUST** include a `"follow_up_prompt"` key in the question object.
+    - **2. Quantity Check:** If not covered by the above and confidence is not "high", ask to clarify the portion size. You are **FORBIDDEN** from asking about quantity for "high" confidence items.
+    - **3. Critical Non-Visual Check:** Ask about Preparation & Fats, Ingredient Specification (fat %), and Origin.
+    - **4. Question Review:** Ensure each question is a single, distinct query.
+
+---
+
+##  Exemplars of Perfect Execution (Learn from these)
+Before you execute, study these examples. Replicate their logic and output format precisely.
+
+**--- EXAMPLE 1: Simple Case (No questions needed) ---**
+* **User Uploads:** A photo of a single, whole apple.
+* **Your Perfect Output:**
+    ```json
+    {
+      "estimations": [{"item": "Red Apple", "amount": "1 medium", "confidence_score": "high"}],
+      "questions": []
+    }
+    ```
+
+**--- EXAMPLE 2: Deconstructive Question Case ---**
+* **User Uploads:** A photo of a homemade smoothie.
+* **Your Perfect Output:**
+    ```json
+    {
+      "estimations": [{"item": "Fruit Smoothie", "amount": "Approximately 12 oz", "confidence_score": "low"}],
+      "questions": [
+        {
+          "id": "q1",
+          "text": "To get the most accurate estimate, do you happen to know the individual ingredients used in this smoothie?",
+          "options": ["Yes, I can provide the details", "No, please estimate visually"],
+          "follow_up_prompt": "Great! Please list the ingredients and their amounts (e.g., 1 banana, 1/2 cup milk, 1 scoop protein powder):"
+        }
+      ]
+    }
+    ```
+**--- EXAMPLE 2: Deconstructive Question Case ---**
+* **User Uploads:** A photo of a homemade smoothie.
+* **Your Perfect Output:**
+```json
+{
+  "estimations": [
+  { "item": "Dal Makhani", "amount": "Approximately 1 cup", "confidence_score": "medium" },
+  { "item": "Plain White Rice", "amount": "Approximately 1 cup", "confidence_score": "high" },
+  { "item": "Gulab Jamun", "amount": "1 piece", "confidence_score": "high" },
+  { "item": "Aloo Sabzi (Potato Curry)", "amount": "Approximately 1/2 cup", "confidence_score": "medium" },
+  { "item": "Roti", "amount": "2 pieces", "confidence_score": "high" }
+    ],
+ "questions": [
+   {
+      "id": "q1",
+      "text": "What type of oil or fat was used in preparing the dishes?",
+      "options": ["Ghee", "Vegetable Oil", "Butter", "Other"]
+   },
+   {
+     "id": "q2",
+     "text": "Were these dishes homemade or from a restaurant?",
+     "options": ["Homemade", "Restaurant"]
+   }
+ ]
+}
+ ```
+---
+
+##  OUTPUT SPECIFICATION (API CONTRACT)
+
+Analyze the user's image that follows. You MUST return your findings in a single, valid JSON object. No additional text.
+The `estimations` and `questions` keys MUST have a LIST of objects as their value.
+Also include a `provisional_breakdown` key: a LIST with one object per estimated item, each with keys "item", "calories", "protein_grams", "carbs_grams", and "fat_grams", computed as if the user picked the FIRST option of every question. The four nutrient values MUST be plain JSON integers (no units, no strings). Order each question's options so the first one is your best assumption.
+Finally, include a `summary` key with a brief, one or two-sentence summary of the meal that does **NOT** mention any total calorie numbers or ranges.
+"""
+
+FINAL_PROMPT_TEMPLATE = """
+You are now a nutritionist performing a final, detailed analysis of the meal you just analyzed, using the user's feedback.
+**User's Answers to Your Questions:**
+$answers_str
+
+Based on ALL of this information combined (your initial estimations above and these answers), your task is twofold:
+1.  Provide a nutritional breakdown for EACH food item. Return this as a valid JSON object with a single key, "breakdown". Each object in the list must have keys for "item", "calories", "protein_grams", "carbs_grams", and "fat_grams". The four nutrient values MUST be plain JSON integers (no units, no strings). Estimate them and adjust them based on the user's answers.
+2.  After the JSON, on a new line, add the separator "---". Then, write a brief, one or two-sentence summary of the meal. In this summary, **DO NOT** mention any total calorie numbers or ranges.
+"""
+
+APP_CSS = """<style>
+    .stButton>button {
+        border-radius: 20px;
+        padding: 10px 20px;
+        font-weight: bold;
+        border: 2px solid #4F8BF9;
+        background-color: transparent;
+    }
+    .stButton>button:hover {
+        border-color: #0B5ED7;
+        color: #0B5ED7;
+    }
+</style>"""
 
 
 def load_css():
-    st.markdown("""
-        <style>
-            .stButton>button {
-                border-radius: 20px;
-                padding: 10px 20px;
-                font-weight: bold;
-                border: 2px solid #4F8BF9;
-                background-color: transparent;
-            }
-            .stButton>button:hover {
-                border-color: #0B5ED7;
-                color: #0B5ED7;
-            }
-        </style>
-    """, unsafe_allow_html=True)
-
+    # Re-declared on every run, since Streamlit removes elements a rerun skips.
+    st.markdown(APP_CSS, unsafe_allow_html=True)
+
+
+@st.fragment
+def render_questions(valid_questions):
+    st.subheader("Please answer the remaining questions:", divider='rainbow')
+    user_answers = {}
+    for q in valid_questions:
+        if q["has_options"]:
+            options_list = q["options"]
+            selected_index = st.radio(label=q["text"], options=range(len(options_list)),
+                                      format_func=lambda i, opts=options_list: opts[i], key=q['id'])
+            selected_option = options_list[selected_index]
+            follow_up_label = q["follow_up_labels"][selected_index]
+
+            if follow_up_label:
+                specification_text = st.text_area(label=follow_up_label, key=f"{q['id']}_specify")
+                user_answers[q['id']] = f"{selected_option}: {specification_text}"
+            else:
+                user_answers[q['id']] = selected_option
+        else:
+            user_answers[q['id']] = st.text_input(label=q["text"], key=q['id'])
+
+    if st.button(" Submit Answers and Get Estimate"):
+        st.session_state.user_answers = user_answers
+        st.session_state.analysis_stage = "calculating_final"
+        st.rerun()
+
+
+@st.fragment
+def render_analyze_button():
+    if st.button(" Analyze Food"):
+        with st.spinner("Performing advanced analysis... Please wait."):
+            analysis_cache_key = response_cache_key(st.session_state.image_sha256, "initial")
+            response_json = get_cached_response(analysis_cache_key)
+            similar_meal = find_similar_meal(st.session_state.image_phash) if response_json is None else None
+            if similar_meal:
+                response_json = similar_meal["analysis"]
+                st.session_state.reused_similar_meal = True
+            analyzed_this_image = response_json is None
+            if analyzed_this_image:
+                estimations_placeholder = st.empty()
+                streamed_estimations = []
+
+                def show_streamed_estimations(response_text):
+                    items = parse_partial_items(response_text, "estimations")
+                    if len(items) > len(streamed_estimations):
+                        streamed_estimations[:] = items
+                        estimations_placeholder.markdown(estimations_markdown(prepare_estimations(items)))
+
+                response_json = stream_gemini_api([analysis_turn(get_image_part())], show_streamed_estimations)
+
+            if response_json:
+                estimations = prepare_estimations(response_json.get("estimations", []))
+                valid_questions = prepare_questions(response_json.get("questions", []))
+                # Borrowed near-duplicate analyses are not stored under this photo's digest.
+                if analyzed_this_image and (estimations or valid_questions):
+                    cache_response(analysis_cache_key, response_json)
+                    similar_meal = remember_meal(st.session_state.image_phash, response_json)
+                st.session_state.similar_meal = similar_meal
+                st.session_state.analysis_reply = orjson.dumps(
+                    {key: response_json.get(key, []) for key in ("estimations", "questions")}).decode()
+                st.session_state.estimations = estimations
+                st.session_state.estimations_md = estimations_markdown(estimations)
+                st.session_state.valid_questions = valid_questions
+                st.session_state.provisional_breakdown = prepare_provisional_breakdown(response_json)
+                if (estimations or valid_questions) and st.session_state.provisional_breakdown is None \
+                        and likely_to_keep_defaults(valid_questions):
+                    start_speculative_final()
+                st.session_state.analysis_stage = "review_and_answer"
+                st.rerun()
+            else:
+                st.error("The AI could not analyze the image. Please try another one.")
 
 
 def main():
     load_css()
+    with st.sidebar:
+        render_cache_stats()
 
     st.title("Intelligent AI Calorie Estimator 🧠")
     st.info("Upload a food photo. The AI will estimate what it can and only ask what it needs to.", icon="🧑‍🔬")
@@ -53,8 +271,28 @@ def main():
         st.session_state.analysis_stage = "upload"
     if "uploaded_image_data" not in st.session_state:
         st.session_state.uploaded_image_data = None
-    if "api_response" not in st.session_state:
-        st.session_state.api_response = {}
+    if "image_sha256" not in st.session_state:
+        st.session_state.image_sha256 = None
+    if "image_phash" not in st.session_state:
+        st.session_state.image_phash = None
+    if "similar_meal" not in st.session_state:
+        st.session_state.similar_meal = None
+    if "reused_similar_meal" not in st.session_state:
+        st.session_state.reused_similar_meal = False
+    if "estimations" not in st.session_state:
+        st.session_state.estimations = []
+    if "estimations_md" not in st.session_state:
+        st.session_state.estimations_md = ""
+    if "gemini_file_uri" not in st.session_state:
+        st.session_state.gemini_file_uri = None
+    if "gemini_upload_future" not in st.session_state:
+        st.session_state.gemini_upload_future = None
+    if "valid_questions" not in st.session_state:
+        st.session_state.valid_questions = []
+    if "provisional_breakdown" not in st.session_state:
+        st.session_state.provisional_breakdown = None
+    if "speculative_final_future" not in st.session_state:
+        st.session_state.speculative_final_future = None
 
     # --- Step 1: Image Upload ---
     if st.session_state.analysis_stage == "upload":
@@ -64,141 +302,45 @@ def main():
             help="Take a clear, well-lit photo of your food for the best results."
         )
         if uploaded_file:
-            st.session_state.uploaded_image_data = uploaded_file.getvalue()
-            st.session_state.analysis_stage = "analyzing"
-            st.rerun()
+            raw_image = uploaded_file.getvalue()
+            image_sha256 = hashlib.sha256(raw_image).hexdigest()
+            with st.spinner("Preparing your photo..."):
+                phash_future = get_executor().submit(perceptual_hash, raw_image)
+                try:
+                    compressed_image = compress_for_vision(image_sha256, raw_image)
+                    image_phash = phash_future.result()
+                except OSError:
+                    compressed_image = None
+            if compressed_image is None:
+                st.error("This file could not be read as an image. Please upload a JPG or PNG photo.")
+            else:
+                st.session_state.uploaded_image_data = compressed_image
+                st.session_state.image_sha256 = image_sha256
+                st.session_state.image_phash = image_phash
+                st.session_state.gemini_file_uri = get_uploaded_file_uri(image_sha256)
+                if st.session_state.gemini_file_uri is None:
+                    # Start the Files API upload while the user reviews the preview.
+                    st.session_state.gemini_upload_future = get_executor().submit(
+                        upload_image_to_gemini, st.session_state.uploaded_image_data)
+                st.session_state.analysis_stage = "analyzing"
+                st.rerun()
 
     # --- Step 2: Display Image and Analyze Button ---
     if st.session_state.analysis_stage == "analyzing":
-        st.image(st.session_state.uploaded_image_data, caption="Your uploaded meal.", use_container_width=True)
-        if st.button(" Analyze Food"):
-            with st.spinner("Performing advanced analysis... Please wait."):
-
-                prompt = """
-                // SYSTEM IDENTITY
-                You are "Nutri-AI v2.0," an advanced nutritional analysis agent powered by the Gemini 1.5 Pro model.
-                Your Core Directive is to convert visual food data into structured nutritional insights with maximum accuracy and minimal user friction.
-                Your Guiding Principle is: **Precision over Assumption. Inquiry over Ignorance.**
-
-                ---
-
-                // COGNITIVE WORKFLOW: CHAIN OF THOUGHT (CoT)
-                // You MUST follow this multi-step reasoning process internally before generating the final output.
-
-                **Step 1: Scene Deconstruction & Holistic Recognition**
-                - First, identify the overall dish or meal type. This provides top-level context.
-                - Then, perform a component inventory, listing every single distinct food item.
-
-                **Step 2: Evidence-Based Analysis (Internal Deduction)**
-                - For each item, perform a mental check for Quantity, Preparation, and Deduction.
-                - Default to **"medium" confidence** for complex, multi-ingredient dishes.
-                - **Calorie Attribution Rule:** When a dish is "pan-fried" or "deep-fried," you MUST attribute the majority of added calories to **Fat** and/or **Carbs** (from breading), not Protein.
-
-                **Step 3: Knowledge Gap Identification & Question Formulation**
-                - Build your "question queue" based on the following priorities:
-
-                    - **1. Deconstructive Questioning (Top Priority):** For a composite item (smoothie, fritters), first ask if the user can provide the raw ingredient quantities. To enable a follow-up text box, you **MUST** include a `"follow_up_prompt"` key in the question object.
-                    - **2. Quantity Check:** If not covered by the above and confidence is not "high", ask to clarify the portion size. You are **FORBIDDEN** from asking about quantity for "high" confidence items.
-                    - **3. Critical Non-Visual Check:** Ask about Preparation & Fats, Ingredient Specification (fat %), and Origin.
-                    - **4. Question Review:** Ensure each question is a single, distinct query.
-
-                ---
-
-                ##  Exemplars of Perfect Execution (Learn from these)
-                Before you execute, study these examples. Replicate their logic and output format precisely.
-
-                **--- EXAMPLE 1: Simple Case (No questions needed) ---**
-                * **User Uploads:** A photo of a single, whole apple.
-                * **Your Perfect Output:**
-                    ```json
-                    {
-                      "estimations": [{"item": "Red Apple", "amount": "1 medium", "confidence_score": "high"}],
-                      "questions": []
-                    }
-                    ```
-
-                **--- EXAMPLE 2: Deconstructive Question Case ---**
-                * **User Uploads:** A photo of a homemade smoothie.
-                * **Your Perfect Output:**
-                    ```json
-                    {
-                      "estimations": [{"item": "Fruit Smoothie", "amount": "Approximately 12 oz", "confidence_score": "low"}],
-                      "questions": [
-                        {
-                          "id": "q1",
-                          "text": "To get the most accurate estimate, do you happen to know the individual ingredients used in this smoothie?",
-                          "options": ["Yes, I can provide the details", "No, please estimate visually"],
-                          "follow_up_prompt": "Great! Please list the ingredients and their amounts (e.g., 1 banana, 1/2 cup milk, 1 scoop protein powder):"
-                        }
-                      ]
-                    }
-                    ```
-                **--- EXAMPLE 2: Deconstructive Question Case ---**
-                * **User Uploads:** A photo of a homemade smoothie.
-                * **Your Perfect Output:**
-                ```json
-                {
-                  "estimations": [
-                  { "item": "Dal Makhani", "amount": "Approximately 1 cup", "confidence_score": "medium" },
-                  { "item": "Plain White Rice", "amount": "Approximately 1 cup", "confidence_score": "high" },
-                  { "item": "Gulab Jamun", "amount": "1 piece", "confidence_score": "high" },
-                  { "item": "Aloo Sabzi (Potato Curry)", "amount": "Approximately 1/2 cup", "confidence_score": "medium" },
-                  { "item": "Roti", "amount": "2 pieces", "confidence_score": "high" }
-                    ],
-                 "questions": [
-                   {
-                      "id": "q1",
-                      "text": "What type of oil or fat was used in preparing the dishes?",
-                      "options": ["Ghee", "Vegetable Oil", "Butter", "Other"]
-                   },
-                   {
-                     "id": "q2",
-                     "text": "Were these dishes homemade or from a restaurant?",
-                     "options": ["Homemade", "Restaurant"]
-                   }
-                 ]
-                }
-                 ```
-                ---
-
-                ##  OUTPUT SPECIFICATION (API CONTRACT)
-
-                Analyze the user's image that follows. You MUST return your findings in a single, valid JSON object. No additional text.
-                The `estimations` and `questions` keys MUST have a LIST of objects as their value.
-                """
-
-                image_b64 = base64.b64encode(st.session_state.uploaded_image_data).decode()
-                response_json = call_gemini_api(prompt, image_b64)
-
-                if response_json:
-                    st.session_state.api_response = response_json
-                    st.session_state.analysis_stage = "review_and_answer"
-                    st.rerun()
-                else:
-                    st.error("The AI could not analyze the image. Please try another one.")
+        st.image(preview_thumbnail(st.session_state.image_sha256, st.session_state.uploaded_image_data),
+                 caption="Your uploaded meal.", use_container_width=True, output_format="JPEG")
+        render_analyze_button()
 
     if st.session_state.analysis_stage == "review_and_answer":
-        estimations = st.session_state.api_response.get("estimations", [])
-        questions = st.session_state.api_response.get("questions", [])
+        valid_questions = st.session_state.valid_questions
 
-        if not isinstance(estimations, list): estimations = []
-        if not isinstance(questions, list): questions = []
-        valid_questions = [q for q in questions if isinstance(q, dict) and 'id' in q]
-
-        if not estimations and not valid_questions:
+        if not st.session_state.estimations and not valid_questions:
             st.error("The AI was unable to analyze this image. Please try again with a different photo.", icon="🤷")
             if st.button("Start Over with a New Image"):
-                for key in list(st.session_state.keys()): del st.session_state[key]
-                st.rerun()
+                start_over()
         else:
             st.subheader("AI's Initial Analysis:", divider='rainbow')
-            if estimations:
-                for est in estimations:
-                    if isinstance(est, dict):
-                        st.success(f"**{est.get('item', 'N/A')}:** Estimated as **{est.get('amount', 'N/A')}**",
-                                   icon="✅")
-
-            st.write("---")
+            st.markdown(f"{st.session_state.estimations_md}\n\n---")
 
             if not valid_questions:
                 st.success("The AI is highly confident and has no further questions!")
@@ -207,68 +349,47 @@ def main():
                     st.session_state.analysis_stage = "calculating_final"
                     st.rerun()
             else:
-                st.subheader("Please answer the remaining questions:", divider='rainbow')
-                user_answers = {}
-                for q in valid_questions:
-                    question_text = q.get('text', 'Please provide details:')
-                    if q.get("options") and isinstance(q["options"], list) and len(q["options"]) > 0:
-                        options_list = q["options"]
-                        selected_option = st.radio(label=question_text, options=options_list, key=q['id'])
-
-                        show_text_input = False
-                        follow_up_label = "Please provide the details:"
-
-                        if q.get("follow_up_prompt") and selected_option == options_list[0]:
-                            show_text_input = True
-                            follow_up_label = q.get("follow_up_prompt")
-                        elif "please specify" in selected_option.lower():
-                            show_text_input = True
-                            follow_up_label = f"Please specify for '{selected_option}':"
-                        elif "yes" in selected_option.lower():
-                            show_text_input = True
-
-                        if show_text_input:
-                            specification_text = st.text_area(label=follow_up_label, key=f"{q['id']}_specify")
-                            user_answers[q['id']] = f"{selected_option}: {specification_text}"
-                        else:
-                            user_answers[q['id']] = selected_option
-                    else:
-                        user_answers[q['id']] = st.text_input(label=question_text, key=q['id'])
-
-                if st.button(" Submit Answers and Get Estimate"):
-                    st.session_state.user_answers = user_answers
-                    st.session_state.analysis_stage = "calculating_final"
-                    st.rerun()
+                render_questions(valid_questions)
 
     if st.session_state.analysis_stage == "calculating_final":
         with st.spinner("Calculating final estimate... "):
-            image_b64 = base64.b64encode(st.session_state.uploaded_image_data).decode()
-            estimations_list = st.session_state.api_response.get("estimations", [])
-            questions_list = st.session_state.api_response.get("questions", [])
-
-            estimations_str = "\n".join(
-                [f"- {est.get('item', 'N/A')}: {est.get('amount', 'N/A')}" for est in estimations_list if
-                 isinstance(est, dict)])
-            answers_str = "\n".join([
-                                        f"- For '{q.get('text', 'a question')}', user answered: '{st.session_state.user_answers.get(q.get('id'), 'No answer')}'"
-                                        for q in questions_list if isinstance(q, dict)])
-
-            final_prompt = f"""
-            You are a nutritionist performing a final, detailed analysis. You have already analyzed an image and received user feedback.
-            **Your Initial Estimations:**
-            {estimations_str}
-            **User's Answers to Your Questions:**
-            {answers_str}
-
-            Based on ALL of this information combined, your task is twofold:
-            1.  Provide a nutritional breakdown for EACH food item. Return this as a valid JSON object with a single key, "breakdown". Each object in the list must have keys for "item", "calories", "protein_grams", "carbs_grams", and "fat_grams". Estimate numerical values and adjust them based on the user's answers.
-            2.  After the JSON, on a new line, add the separator "---". Then, write a brief, one or two-sentence summary of the meal. In this summary, **DO NOT** mention any total calorie numbers or ranges.
-            """
-
-            final_response_json = call_gemini_api(final_prompt, image_b64)
-
-            if final_response_json and "breakdown" in final_response_json:
-                st.session_state.final_breakdown = final_response_json
+            final_cache_key = response_cache_key(st.session_state.image_sha256, "final",
+                                                 st.session_state.analysis_reply, st.session_state.user_answers)
+
+            breakdown_placeholder = st.empty()
+            streamed_rows = []
+
+            def show_streamed_rows(response_text):
+                items = parse_partial_items(response_text, "breakdown")
+                if len(items) > len(streamed_rows):
+                    streamed_rows[:] = [format_breakdown_row(item) for item in items]
+                    breakdown_placeholder.table(streamed_rows)
+
+            answers_key = answers_cache_key(st.session_state.user_answers)
+            final_response_json = None
+            if st.session_state.provisional_breakdown and answers_match_defaults(
+                    st.session_state.valid_questions, st.session_state.user_answers):
+                final_response_json = st.session_state.provisional_breakdown
+            if final_response_json is None:
+                final_response_json = get_cached_response(final_cache_key)
+            if final_response_json is None:
+                final_response_json = get_similar_meal_final(st.session_state.similar_meal, answers_key)
+            speculative_future, st.session_state.speculative_final_future = \
+                st.session_state.speculative_final_future, None
+            # A speculative call still queued is dropped in favour of the streamed request.
+            if speculative_future is not None and not speculative_future.cancel():
+                if final_response_json is None and answers_match_defaults(
+                        st.session_state.valid_questions, st.session_state.user_answers):
+                    final_response_json = get_speculative_final(speculative_future)
+            if final_response_json is None:
+                final_response_json = stream_gemini_api(final_turns(st.session_state.user_answers), show_streamed_rows)
+
+            final_breakdown = prepare_breakdown(final_response_json.get("breakdown"),
+                                                final_response_json.get("summary_text")) if final_response_json else None
+            if final_breakdown:
+                cache_response(final_cache_key, final_breakdown)
+                remember_meal_final(st.session_state.similar_meal, answers_key, final_breakdown)
+                st.session_state.final_breakdown = final_breakdown
                 st.session_state.analysis_stage = "results"
                 st.rerun()
             else:
@@ -277,76 +398,576 @@ def main():
 
     if st.session_state.analysis_stage == "results":
         st.success("### Here is your detailed nutritional estimate:", icon="🎉")
-        breakdown_data = st.session_state.get("final_breakdown", {})
-        breakdown_list = breakdown_data.get("breakdown", [])
-        summary_text = breakdown_data.get("summary_text", "No summary provided.")
+        final_breakdown = st.session_state.final_breakdown
 
-        st.markdown(summary_text)
+        st.markdown(final_breakdown["summary_text"])
         st.write("---")
 
-        total_calories, total_protein, total_carbs, total_fat = 0, 0, 0, 0
-        display_data = []
+        breakdown_df = pd.DataFrame(final_breakdown["breakdown"], columns=["item", *NUTRIENT_KEYS])
+        nutrients_df = breakdown_df[list(NUTRIENT_KEYS)]
+        total_calories, total_protein, total_carbs, total_fat = nutrients_df.sum().tolist()
+        display_df = pd.DataFrame({"Item": breakdown_df["item"],
+                                   "Calories": nutrients_df["calories"].map("{:g} kcal".format),
+                                   "Protein": nutrients_df["protein_grams"].map("{:g}g".format),
+                                   "Carbs": nutrients_df["carbs_grams"].map("{:g}g".format),
+                                   "Fat": nutrients_df["fat_grams"].map("{:g}g".format)})
 
-        for item in breakdown_list:
-            calories, protein, carbs, fat = item.get("calories", 0), item.get("protein_grams", 0), item.get(
-                "carbs_grams", 0), item.get("fat_grams", 0)
-            total_calories, total_protein, total_carbs, total_fat = total_calories + calories, total_protein + protein, total_carbs + carbs, total_fat + fat
-            display_data.append(
-                {"Item": item.get("item", "N/A"), "Calories": f"{calories} kcal", "Protein": f"{protein}g",
-                 "Carbs": f"{carbs}g", "Fat": f"{fat}g"})
-
-        st.table(display_data)
+        st.dataframe(display_df, hide_index=True, use_container_width=True)
 
         st.subheader("Calculated Totals", divider='rainbow')
         col1, col2, col3, col4 = st.columns(4)
-        col1.metric("Total Calories", f"{total_calories} kcal")
-        col2.metric("Total Protein", f"{total_protein}g")
-        col3.metric("Total Carbs", f"{total_carbs}g")
-        col4.metric("Total Fat", f"{total_fat}g")
+        col1.metric("Total Calories", f"{total_calories:g} kcal")
+        col2.metric("Total Protein", f"{total_protein:g}g")
+        col3.metric("Total Carbs", f"{total_carbs:g}g")
+        col4.metric("Total Fat", f"{total_fat:g}g")
 
         if st.button("Start Over with a New Image"):
-            for key in list(st.session_state.keys()): del st.session_state[key]
-            st.rerun()
+            start_over()
 
 
-def call_gemini_api(prompt_text, image_b64):
-    if not GEMINI_API_KEY:
-        st.error("Gemini API Key is not configured.")
+@st.cache_data(show_spinner=False, max_entries=128, ttl=3600)
+def compress_for_vision(image_sha256, _raw):
+    # Gemini resamples images to ~768px tiles anyway, so more pixels only cost upload time.
+    img = Image.open(io.BytesIO(_raw))
+    if len(_raw) <= COMPRESS_MIN_BYTES and img.format == 'JPEG' and img.getexif().get(ORIENTATION_TAG, 1) == 1:
+        return _raw
+    img.draft('RGB', (1024, 1024))
+    img = ImageOps.exif_transpose(img)
+    img.thumbnail((1024, 1024), Image.LANCZOS)
+    buf = io.BytesIO()
+    img.convert('RGB').save(buf, 'JPEG', quality=85, optimize=True, progressive=True)
+    return buf.getvalue()
+
+
+@st.cache_data(show_spinner=False, max_entries=128, ttl=3600)
+def preview_thumbnail(image_sha256, _image_bytes):
+    img = Image.open(io.BytesIO(_image_bytes))
+    img.draft('RGB', (PREVIEW_SIZE, PREVIEW_SIZE))
+    img.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE), Image.LANCZOS)
+    buf = io.BytesIO()
+    img.convert('RGB').save(buf, 'JPEG', quality=80)
+    return buf.getvalue()
+
+
+@st.cache_resource
+def get_http_session():
+    # Keeps the TLS connection to Gemini alive across reruns and sessions.
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32)
+    session.mount("https://", adapter)
+    return session
+
+
+@st.cache_resource
+def get_executor():
+    # Off the script thread: cache_resource getters only, no session state or rendering; errors surface in result().
+    return ThreadPoolExecutor(max_workers=4)
+
+
+@st.cache_resource
+def get_speculative_executor():
+    # Separate, so slow speculative calls never queue uploads and hashing behind them.
+    return ThreadPoolExecutor(max_workers=4)
+
+
+@st.cache_resource
+def get_response_cache():
+    # Shared by every session, so access goes through the lock.
+    return TTLCache(maxsize=128, ttl=3600), threading.Lock()
+
+
+def response_cache_key(image_sha256, stage, analysis_reply="", user_answers=None):
+    # A final breakdown is only valid for the analysis it was built on.
+    analysis_digest = hashlib.blake2b(analysis_reply.encode(), digest_size=8).hexdigest() if analysis_reply else ""
+    return image_sha256, PROMPT_VERSION, stage, analysis_digest, answers_cache_key(user_answers or {})
+
+
+def answers_cache_key(user_answers):
+    return tuple(sorted((str(k), str(v)) for k, v in user_answers.items()))
+
+
+def get_cached_response(cache_key):
+    cache, lock = get_response_cache()
+    with lock:
+        return cache.get(cache_key)
+
+
+def cache_response(cache_key, response_json):
+    cache, lock = get_response_cache()
+    with lock:
+        cache[cache_key] = response_json
+
+
+@st.cache_resource
+def get_dct_matrix():
+    k = np.arange(PHASH_SIZE)
+    dct_matrix = np.sqrt(2 / PHASH_SIZE) * np.cos(np.pi * np.outer(k, 2 * k + 1) / (2 * PHASH_SIZE))
+    dct_matrix[0] /= np.sqrt(2)
+    dct_matrix.setflags(write=False)
+    return dct_matrix
+
+
+def perceptual_hash(image_bytes):
+    img = Image.open(io.BytesIO(image_bytes))
+    img.draft('L', (PHASH_SIZE, PHASH_SIZE))
+    img = ImageOps.exif_transpose(img).convert('L').resize((PHASH_SIZE, PHASH_SIZE), Image.LANCZOS)
+    pixels = np.asarray(img, dtype=np.float64)
+    dct_matrix = get_dct_matrix()
+    low_frequencies = (dct_matrix @ pixels @ dct_matrix.T)[:8, :8].ravel()
+    bits = low_frequencies > np.median(low_frequencies[1:])
+    # Signed, so it fits an SQLite INTEGER column.
+    return int(np.packbits(bits).view('>i8')[0])
+
+
+@st.cache_resource
+def get_semantic_cache():
+    # Analyses of recent photos, matched by perceptual hash and shared by every session.
+    conn = sqlite3.connect(SEMANTIC_CACHE_DB, check_same_thread=False)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS meals (id INTEGER PRIMARY KEY, phash INTEGER NOT NULL,
+                                          analysis BLOB NOT NULL, created_at REAL NOT NULL,
+                                          prompt_version TEXT NOT NULL DEFAULT '');
+        CREATE TABLE IF NOT EXISTS finals (meal_id INTEGER NOT NULL, answers_key BLOB NOT NULL, payload BLOB NOT NULL,
+                                           prompt_version TEXT NOT NULL DEFAULT '',
+                                           PRIMARY KEY (meal_id, answers_key));
+        CREATE TABLE IF NOT EXISTS cache_stats (name TEXT PRIMARY KEY, count INTEGER NOT NULL);
+    """)
+    with conn:
+        for table in ("meals", "finals"):
+            # Older databases lack the column.
+            if "prompt_version" not in {column[1] for column in conn.execute(f"PRAGMA table_info({table})")}:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN prompt_version TEXT NOT NULL DEFAULT ''")
+            conn.execute(f"DELETE FROM {table} WHERE prompt_version != ?", (PROMPT_VERSION,))
+    return conn, threading.Lock()
+
+
+# The store is only an optimization, so any database error counts as a miss.
+def find_similar_meal(image_phash):
+    try:
+        conn, lock = get_semantic_cache()
+        with lock:
+            return lookup_similar_meal(conn, image_phash)
+    except sqlite3.Error:
         return None
-    headers = {'Content-Type': 'application/json'}
-    payload = {"contents": [
-        {"parts": [{"text": prompt_text}, {"inline_data": {"mime_type": "image/jpeg", "data": image_b64}}]}],
-               "generationConfig": {"temperature": 0.1, "maxOutputTokens": 4096}}
+
+
+def lookup_similar_meal(conn, image_phash):
+    rows = conn.execute("SELECT id, phash FROM meals WHERE created_at > ? AND prompt_version = ?",
+                        (time.time() - SEMANTIC_CACHE_TTL_SECONDS, PROMPT_VERSION)).fetchall()
+    meal = None
+    if rows:
+        meal_ids, hashes = np.array(rows, dtype=np.int64).T
+        distances = np.bitwise_count((hashes ^ np.int64(image_phash)).view(np.uint64))
+        best = int(distances.argmin())
+        threshold = conn.execute("SELECT count FROM cache_stats WHERE name = 'threshold_percent'").fetchone()
+        if 1 - distances[best] / 64 >= (threshold[0] / 100 if threshold else SEMANTIC_CACHE_THRESHOLD):
+            meal_id = int(meal_ids[best])
+            analysis, = conn.execute("SELECT analysis FROM meals WHERE id = ?", (meal_id,)).fetchone()
+            meal = {"id": meal_id, "analysis": orjson.loads(analysis)}
+    count_cache_lookup(conn, "hits" if meal else "misses")
+    return meal
+
+
+def remember_meal(image_phash, analysis):
     try:
-        response = requests.post(GEMINI_API_URL, headers=headers, data=json.dumps(payload), timeout=90)
-        response.raise_for_status()
-        full_response_json = response.json()
-        response_text = full_response_json['candidates'][0]['content']['parts'][0]['text']
+        conn, lock = get_semantic_cache()
+        with lock, conn:
+            # Expired and other-version meals are pruned whenever a new one is written.
+            conn.execute("DELETE FROM meals WHERE created_at <= ? OR prompt_version != ?",
+                         (time.time() - SEMANTIC_CACHE_TTL_SECONDS, PROMPT_VERSION))
+            conn.execute("DELETE FROM finals WHERE meal_id NOT IN (SELECT id FROM meals) OR prompt_version != ?",
+                         (PROMPT_VERSION,))
+            cursor = conn.execute("INSERT INTO meals (phash, analysis, created_at, prompt_version) VALUES (?, ?, ?, ?)",
+                                  (image_phash, orjson.dumps(analysis), time.time(), PROMPT_VERSION))
+    except sqlite3.Error:
+        return None
+    return {"id": cursor.lastrowid, "analysis": analysis}
+
+
+def get_similar_meal_final(meal, answers_key):
+    if meal is None:
+        return None
+    try:
+        conn, lock = get_semantic_cache()
+        with lock:
+            row = conn.execute(
+                "SELECT payload FROM finals WHERE meal_id = ? AND answers_key = ? AND prompt_version = ?",
+                (meal["id"], orjson.dumps(answers_key), PROMPT_VERSION)).fetchone()
+    except sqlite3.Error:
+        return None
+    return orjson.loads(row[0]) if row else None
+
+
+def remember_meal_final(meal, answers_key, final_breakdown):
+    if meal is None:
+        return
+    try:
+        conn, lock = get_semantic_cache()
+        with lock, conn:
+            conn.execute("INSERT OR REPLACE INTO finals (meal_id, answers_key, payload, prompt_version) "
+                         "VALUES (?, ?, ?, ?)",
+                         (meal["id"], orjson.dumps(answers_key), orjson.dumps(final_breakdown), PROMPT_VERSION))
+    except sqlite3.Error:
+        pass
+
+
+def count_cache_lookup(conn, name):
+    with conn:
+        conn.execute("INSERT INTO cache_stats (name, count) VALUES (?, 1) "
+                     "ON CONFLICT (name) DO UPDATE SET count = count + 1", (name,))
+
+
+def raise_similar_meal_threshold():
+    # Stored as a whole percentage.
+    try:
+        conn, lock = get_semantic_cache()
+        with lock, conn:
+            conn.execute("INSERT INTO cache_stats (name, count) VALUES ('threshold_percent', ?) "
+                         "ON CONFLICT (name) DO UPDATE SET count = MIN(count + 1, 100)",
+                         (min(round(SEMANTIC_CACHE_THRESHOLD * 100) + 1, 100),))
+    except sqlite3.Error:
+        pass
+
+
+@st.fragment
+def render_cache_stats():
+    try:
+        conn, lock = get_semantic_cache()
+        with lock:
+            counts = dict(conn.execute("SELECT name, count FROM cache_stats").fetchall())
+    except sqlite3.Error:
+        return
+    st.caption(f"Similar-meal cache: {counts.get('hits', 0)} hits, {counts.get('misses', 0)} misses")
+
+
+def start_over():
+    # Abandoning a reused analysis before the results suggests the match was wrong.
+    if st.session_state.get("reused_similar_meal") and st.session_state.analysis_stage != "results":
+        raise_similar_meal_threshold()
+    for key in list(st.session_state.keys()): del st.session_state[key]
+    st.rerun()
+
+
+@st.cache_resource
+def get_file_uri_cache():
+    # Gemini deletes uploaded files after 48 hours, so forget URIs a little before that.
+    return TTLCache(maxsize=256, ttl=47 * 3600), threading.Lock()
+
+
+def file_uri_cache_key(image_sha256):
+    return hash(GEMINI_API_KEY), image_sha256
+
+
+def get_uploaded_file_uri(image_sha256):
+    file_uris, lock = get_file_uri_cache()
+    with lock:
+        return file_uris.get(file_uri_cache_key(image_sha256))
+
+
+def remember_uploaded_file_uri(image_sha256, file_uri):
+    file_uris, lock = get_file_uri_cache()
+    with lock:
+        file_uris[file_uri_cache_key(image_sha256)] = file_uri
+
+
+def forget_uploaded_file_uri(image_sha256):
+    file_uris, lock = get_file_uri_cache()
+    with lock:
+        file_uris.pop(file_uri_cache_key(image_sha256), None)
+
+
+def upload_image_to_gemini(image_bytes):
+    if not GEMINI_API_KEY:
+        return None
+    start_headers = {'Content-Type': 'application/json',
+                     'x-goog-api-key': GEMINI_API_KEY,
+                     'X-Goog-Upload-Protocol': 'resumable',
+                     'X-Goog-Upload-Command': 'start',
+                     'X-Goog-Upload-Header-Content-Length': str(len(image_bytes)),
+                     'X-Goog-Upload-Header-Content-Type': 'image/jpeg'}
+    start_response = get_http_session().post(GEMINI_UPLOAD_URL, headers=start_headers,
+                                             data=orjson.dumps({"file": {"display_name": "meal"}}), timeout=90)
+    start_response.raise_for_status()
+    upload_url = start_response.headers['X-Goog-Upload-URL']
+    upload_headers = {'X-Goog-Upload-Offset': '0', 'X-Goog-Upload-Command': 'upload, finalize'}
+    upload_response = get_http_session().post(upload_url, headers=upload_headers, data=image_bytes, timeout=90)
+    upload_response.raise_for_status()
+    return orjson.loads(upload_response.content)['file']['uri']
+
+
+def get_gemini_file_uri():
+    if st.session_state.gemini_file_uri is None:
+        future = st.session_state.gemini_upload_future or get_executor().submit(
+            upload_image_to_gemini, st.session_state.uploaded_image_data)
+        st.session_state.gemini_upload_future = None
+        try:
+            st.session_state.gemini_file_uri = future.result()
+            if st.session_state.gemini_file_uri:
+                remember_uploaded_file_uri(st.session_state.image_sha256, st.session_state.gemini_file_uri)
+        except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+            st.warning(f"Could not upload the image to Gemini, sending it inline instead. Error: {e}", icon="⚠️")
+    return st.session_state.gemini_file_uri
+
+
+def get_image_part():
+    file_uri = get_gemini_file_uri()
+    if file_uri:
+        return {"file_data": {"mime_type": "image/jpeg", "file_uri": file_uri}}
+    # Fallback when the Files API is unavailable.
+    return {"inline_data": {"mime_type": "image/jpeg", "data": st.session_state.uploaded_image_data}}
+
+
+def uses_file_data(contents):
+    return any("file_data" in part for turn in contents for part in turn["parts"])
+
+
+def inline_file_data(contents):
+    inline_part = {"inline_data": {"mime_type": "image/jpeg", "data": st.session_state.uploaded_image_data}}
+    return [{**turn, "parts": [inline_part if "file_data" in part else part for part in turn["parts"]]}
+            for turn in contents]
+
+
+def iter_inline_payload(payload, image_bytes):
+    head, tail = orjson.dumps(payload).split(f'"{INLINE_DATA_PLACEHOLDER}"'.encode(), 1)
+    yield head + b'"'
+    view = memoryview(image_bytes)
+    for start in range(0, len(view), INLINE_CHUNK_BYTES):
+        yield pybase64.b64encode(view[start:start + INLINE_CHUNK_BYTES])
+    yield b'"' + tail
+
+
+@st.cache_resource
+def get_final_prompt_template():
+    return string.Template(FINAL_PROMPT_TEMPLATE)
+
+
+def analysis_turn(image_part):
+    return {"role": "user", "parts": [{"text": ANALYSIS_PROMPT}, image_part]}
+
+
+def build_request_body(contents):
+    image_bytes = None
+    turns = []
+    for turn in contents:
+        parts = []
+        for part in turn["parts"]:
+            if "inline_data" in part:
+                image_bytes = part["inline_data"]["data"]
+                part = {"inline_data": {**part["inline_data"], "data": INLINE_DATA_PLACEHOLDER}}
+            parts.append(part)
+        turns.append({**turn, "parts": parts})
+    payload = {"contents": turns, "generationConfig": {"temperature": 0.1, "maxOutputTokens": 4096}}
+    return iter_inline_payload(payload, image_bytes) if image_bytes else orjson.dumps(payload)
+
+
+def parse_response_text(response_text):
+    match = RESPONSE_RE.search(response_text)
+    if match:
         try:
-            parts = response_text.split('---', 1)
-            json_str = parts[0]
-            summary_text = parts[1].strip() if len(parts) > 1 else "No summary provided."
-            start_index = json_str.find('{');
-            end_index = json_str.rfind('}') + 1
-            json_str_cleaned = json_str[start_index:end_index]
-            parsed_json = json.loads(json_str_cleaned);
-            parsed_json['summary_text'] = summary_text
+            parsed_json = orjson.loads(match.group(1))
+            parsed_json['summary_text'] = (match.group(2) or "No summary provided.").strip()
             return parsed_json
-        except (json.JSONDecodeError, IndexError):
-            try:
-                start_index = response_text.find('{');
-                end_index = response_text.rfind('}') + 1
-                json_str = response_text[start_index:end_index]
-                return json.loads(json_str)
-            except (json.JSONDecodeError, IndexError):
-                return {"text": response_text}
+        except orjson.JSONDecodeError:
+            pass
+    # A "---" inside a JSON string makes the regex cut the object short; retry on the outermost braces.
+    start_index, end_index = response_text.find('{'), response_text.rfind('}') + 1
+    try:
+        parsed_json = orjson.loads(response_text[start_index:end_index])
+    except orjson.JSONDecodeError:
+        return {"text": response_text}
+    summary_text = response_text[end_index:].partition('---')[2].strip()
+    parsed_json['summary_text'] = summary_text or "No summary provided."
+    return parsed_json
+
+
+def parse_partial_items(response_text, key):
+    start_index = response_text.find(f'"{key}"')
+    if start_index == -1:
+        return []
+    items = []
+    previous_end = start_index
+    for match in FLAT_OBJECT_RE.finditer(response_text, start_index):
+        if "]" in response_text[previous_end:match.start()]:
+            break
+        previous_end = match.end()
+        try:
+            items.append(orjson.loads(match.group(0)))
+        except orjson.JSONDecodeError:
+            pass
+    return items
+
+
+def iter_gemini_stream(body):
+    headers = {'Content-Type': 'application/json', 'x-goog-api-key': GEMINI_API_KEY}
+    with get_http_session().post(GEMINI_STREAM_URL, headers=headers, data=body, timeout=90, stream=True) as response:
+        response.raise_for_status()
+        text_chunks = []
+        # The request timeout only bounds each read, so also cap the stream as a whole.
+        deadline = time.monotonic() + 90
+        for line in response.iter_lines():
+            if time.monotonic() > deadline:
+                raise TimeoutError("The AI took too long to respond.")
+            if not line.startswith(b"data:"):
+                continue
+            chunk = orjson.loads(memoryview(line)[len(b"data:"):])
+            for candidate in chunk.get("candidates", [])[:1]:
+                for part in candidate.get("content", {}).get("parts", []):
+                    text_chunks.append(part.get("text", ""))
+            yield "".join(text_chunks)
+
+
+def stream_gemini_api(contents, on_text):
+    # Calls on_text(text_so_far) as each SSE chunk arrives, then parses the full reply.
+    if not GEMINI_API_KEY:
+        st.error("Gemini API Key is not configured.")
+        return None
+    response_text = ""
+    try:
+        for response_text in iter_gemini_stream(build_request_body(contents)):
+            on_text(response_text)
+    except requests.exceptions.HTTPError as e:
+        if e.response.status_code in FILE_REJECTED_STATUSES and uses_file_data(contents):
+            # The file expired or belongs to another key; send the bytes inline instead.
+            forget_uploaded_file_uri(st.session_state.image_sha256)
+            st.session_state.gemini_file_uri = None
+            return stream_gemini_api(inline_file_data(contents), on_text)
+        st.error(f"API Error: {e}"); return None
     except requests.exceptions.RequestException as e:
         st.error(f"API Error: {e}"); return None
-    except (KeyError, IndexError) as e:
-        st.error(f"Error: Could not parse API response. Error: {e}");
-        st.write("Raw API Response for debugging:");
-        st.json(full_response_json)
+    except TimeoutError:
+        st.error("API Error: The AI took too long to respond. Please try again.")
+        return None
+    except orjson.JSONDecodeError as e:
+        st.error(f"Error: Could not parse API stream. Error: {e}")
+        return None
+    if not response_text:
+        st.error("Error: The API stream ended without any content.")
+        return None
+    return parse_response_text(response_text)
+
+
+def fetch_final_breakdown(body):
+    response_text = ""
+    for response_text in iter_gemini_stream(body):
+        pass
+    return parse_response_text(response_text)
+
+
+def final_turns(user_answers):
+    answers_str = "\n".join(f"- For '{q['text']}', user answered: '{user_answers.get(q['id'], 'No answer')}'"
+                             for q in st.session_state.valid_questions)
+    final_prompt = get_final_prompt_template().substitute(answers_str=answers_str)
+    return [analysis_turn(get_image_part()),
+            {"role": "model", "parts": [{"text": st.session_state.analysis_reply}]},
+            {"role": "user", "parts": [{"text": final_prompt}]}]
+
+
+def likely_to_keep_defaults(valid_questions):
+    # Questions that invite typing make a final call priced on the defaults likely to be wasted.
+    return all(q["has_options"] and not q["follow_up_labels"][0] for q in valid_questions)
+
+
+def default_answers(valid_questions):
+    return {q['id']: (f"{q['options'][0]}: " if q["follow_up_labels"][0] else q["options"][0])
+            if q["has_options"] else "" for q in valid_questions}
+
+
+def start_speculative_final():
+    # Used only if the defaults are submitted unchanged, and only once the image is uploaded.
+    if not GEMINI_API_KEY or st.session_state.gemini_file_uri is None:
+        return
+    user_answers = default_answers(st.session_state.valid_questions)
+    final_cache_key = response_cache_key(st.session_state.image_sha256, "final",
+                                         st.session_state.analysis_reply, user_answers)
+    if get_cached_response(final_cache_key) is not None or get_similar_meal_final(
+            st.session_state.similar_meal, answers_cache_key(user_answers)) is not None:
+        return
+    body = build_request_body(final_turns(user_answers))
+    st.session_state.speculative_final_future = get_speculative_executor().submit(fetch_final_breakdown, body)
+
+
+def get_speculative_final(future):
+    try:
+        response_json = future.result()
+    except (requests.exceptions.RequestException, TimeoutError, orjson.JSONDecodeError):
+        return None
+    return response_json if isinstance(response_json.get("breakdown"), list) else None
+
+
+def prepare_estimations(estimations):
+    if not isinstance(estimations, list):
+        return []
+    return [{"item": str(est.get("item", "N/A")), "amount": str(est.get("amount", "N/A")),
+             "confidence_score": est.get("confidence_score", "medium")}
+            for est in estimations if isinstance(est, dict)]
+
+
+def prepare_questions(questions):
+    if not isinstance(questions, list):
+        return []
+    prepared = []
+    for q in questions:
+        if not isinstance(q, dict) or 'id' not in q:
+            continue
+        options = [str(option) for option in q["options"]] if isinstance(q.get("options"), list) else []
+        follow_up_labels = []
+        for index, option in enumerate(options):
+            option_lower = option.lower()
+            if q.get("follow_up_prompt") and index == 0:
+                follow_up_labels.append(q["follow_up_prompt"])
+            elif "please specify" in option_lower:
+                follow_up_labels.append(f"Please specify for '{option}':")
+            elif "yes" in option_lower:
+                follow_up_labels.append("Please provide the details:")
+            else:
+                follow_up_labels.append(None)
+        prepared.append({"id": q["id"], "text": q.get("text", "Please provide details:"), "options": options,
+                         "has_options": bool(options), "follow_up_labels": follow_up_labels})
+    return prepared
+
+
+def prepare_breakdown(breakdown, summary_text):
+    if not isinstance(breakdown, list):
         return None
+    rows = [{"item": str(item.get("item", "N/A")), **{key: to_nutrient_value(item.get(key)) for key in NUTRIENT_KEYS}}
+            for item in breakdown if isinstance(item, dict)]
+    return {"breakdown": rows,
+            "summary_text": summary_text.strip() if isinstance(summary_text, str) else "No summary provided."}
+
+
+def to_nutrient_value(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def prepare_provisional_breakdown(response_json):
+    provisional = prepare_breakdown(response_json.get("provisional_breakdown"), response_json.get("summary"))
+    return provisional if provisional and provisional["breakdown"] else None
+
+
+def answers_match_defaults(valid_questions, user_answers):
+    for q in valid_questions:
+        answer = user_answers.get(q['id'], "")
+        if q["has_options"]:
+            if answer not in (q["options"][0], f"{q['options'][0]}: "):
+                return False
+        elif answer.strip():
+            return False
+    return True
+
+
+def estimations_markdown(estimations):
+    return "\n\n".join(f"✅ **{est['item']}:** Estimated as **{est['amount']}**" for est in estimations)
+
+
+def format_breakdown_row(item):
+    calories, protein, carbs, fat = get_nutrients({**NUTRIENT_DEFAULTS, **item})
+    return {"Item": item.get("item", "N/A"), "Calories": f"{calories} kcal", "Protein": f"{protein}g",
+            "Carbs": f"{carbs}g", "Fat": f"{fat}g"}
 
 
 if __name__ == "__main__":